@@ -1,10 +1,53 @@
+import os
 import sys
-import copy
-import random
+from collections import Counter, defaultdict, deque
+from functools import lru_cache
 
 from crossword import *
 
 
+def to_bits(ids):
+    """
+    Return an int bitmask with bit k set for each word index k in `ids`.
+    """
+    buffer = bytearray(max(ids, default=0) // 8 + 1)
+    for k in ids:
+        buffer[k >> 3] |= 1 << (k & 7)
+    return int.from_bytes(buffer, "little")
+
+
+def revise_bits(bits_x, bits_y, column_pairs):
+    """
+    Return `bits_x` with every word removed that has no supporting word in
+    `bits_y`. `column_pairs` holds a (y mask, x mask) pair for each letter
+    shared by the overlapping positions of y and x, each mask selecting
+    the words with that letter at that position.
+    """
+    keep = 0
+    for mask_y, mask_x in column_pairs:
+        if bits_y & mask_y: # Some word in y's domain has this letter
+            keep |= mask_x
+    return bits_x & keep
+
+
+# Resolved against this file, so the font is found (and cached under one
+# key) whatever the working directory
+FONT_PATH = os.path.join(
+    os.path.dirname(os.path.abspath(__file__)),
+    "assets", "fonts", "OpenSans-Regular.ttf"
+)
+
+
+@lru_cache(maxsize=None)
+def load_font(path, size):
+    """
+    Load a TrueType font, parsing each font file only once per process.
+    `path` should be absolute, since it is the cache key.
+    """
+    from PIL import ImageFont
+    return ImageFont.truetype(path, size)
+
+
 class CrosswordCreator():
 
     def __init__(self, crossword):
@@ -17,31 +60,125 @@ class CrosswordCreator():
             for var in self.crossword.variables
         }
 
-    def letter_grid(self, assignment):
+        # Number the words of each variable length separately, so that a set
+        # of words of length L can be stored as an int bitmask where bit k is
+        # set if `self.words_by_length[L][k]` is in the set. Masks then stay
+        # only as wide as the words a variable could hold
+        lengths = {var.length for var in self.crossword.variables}
+        self.words_by_length = {
+            length: sorted(word for word in self.crossword.words if len(word) == length)
+            for length in lengths
+        }
+        self.word_id = {
+            word: k
+            for words in self.words_by_length.values()
+            for k, word in enumerate(words)
+        }
+
+        # `self.support[L][position][letter]` is the bitmask of every word of
+        # length L with that letter at that position
+        self.support = dict()
+        for length, words in self.words_by_length.items():
+            columns = [defaultdict(list) for _ in range(length)]
+            for k, word in enumerate(words):
+                for position, letter in enumerate(word):
+                    columns[position][letter].append(k)
+            self.support[length] = [
+                {letter: to_bits(ids) for letter, ids in column.items()}
+                for column in columns
+            ]
+
+        # For each arc (x, y) in the crossword, the (mask at j, mask at i)
+        # pairs for every letter occurring at both overlapping positions, so
+        # revising the arc skips letters that could never match
+        self.column_pairs = dict()
+        for (x, y), overlap in self.crossword.overlaps.items():
+            if overlap is None:
+                continue
+            i, j = overlap
+            column_x = self.support[x.length][i]
+            self.column_pairs[x, y] = tuple(
+                (mask_y, column_x[letter])
+                for letter, mask_y in self.support[y.length][j].items()
+                if letter in column_x
+            )
+
+        # Bitmask copy of `self.domains`, used while propagating and searching.
+        # `self.domains` stays the source of truth: `sync_bits` rebuilds the
+        # masks from it, and `remove_bits` and `restore` keep the two in step
+        self.domain_bits = dict()
+
+        # Neighbors of each variable, computed once rather than on every call
+        self._neighbors = {
+            var: frozenset(self.crossword.neighbors(var))
+            for var in self.crossword.variables
+        }
+        # Variables in a fixed grid order, so ties between them are broken
+        # the same way on every run regardless of hash seed
+        self._ordered_variables = sorted(
+            self.crossword.variables,
+            key=lambda var: (var.i, var.j, var.direction)
+        )
+        # Number of neighbors of each variable, for the degree heuristic
+        self._degree = {
+            var: len(neighbors) for var, neighbors in self._neighbors.items()
+        }
+
+        # Stack of frames, one per open search decision, each listing the
+        # (variable, removed bits) pairs pruned since that decision was made
+        self.trail = []
+
+    def from_bits(self, bits, length):
         """
-        Return 2D array representing a given assignment.
+        Return a list of the words of `length` whose bits are set in `bits`.
         """
-        letters = [
-            [None for _ in range(self.crossword.width)]
-            for _ in range(self.crossword.height)
-        ]
-        for variable, word in assignment.items():
-            direction = variable.direction
-            for k in range(len(word)):
-                i = variable.i + (k if direction == Variable.DOWN else 0)
-                j = variable.j + (k if direction == Variable.ACROSS else 0)
-                letters[i][j] = word[k]
-        return letters
+        words_list = self.words_by_length[length]
+        words = []
+        while bits:
+            lowest = bits & -bits
+            words.append(words_list[lowest.bit_length() - 1])
+            bits ^= lowest
+        return words
+
+    def sync_bits(self):
+        """
+        Rebuild `self.domain_bits` from `self.domains`, which callers may
+        have changed directly.
+        Words the bitmasks cannot represent (of the wrong length for their
+        variable, or not in the vocabulary) are left out; return False if
+        there were any, and True otherwise.
+        """
+        representable = True
+        for var, words in self.domains.items():
+            ids = [
+                self.word_id[word] for word in words
+                if len(word) == var.length and word in self.word_id
+            ]
+            if len(ids) != len(words):
+                representable = False
+            self.domain_bits[var] = to_bits(ids)
+        return representable
+
+    def letter_map(self, assignment):
+        """
+        Return a dict mapping each filled (i, j) cell to its letter
+        in a given assignment.
+        """
+        return {
+            cell: letter
+            for variable, word in assignment.items()
+            for cell, letter in zip(variable.cells, word)
+        }
 
     def print(self, assignment):
         """
         Print crossword assignment to the terminal.
         """
-        letters = self.letter_grid(assignment)
+        letters = self.letter_map(assignment)
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
                 if self.crossword.structure[i][j]:
-                    print(letters[i][j] or " ", end="")
+                    print(letters.get((i, j), " "), end="")
                 else:
                     print("█", end="")
             print()
@@ -50,11 +187,11 @@ class CrosswordCreator():
         """
         Save crossword assignment to an image file.
         """
-        from PIL import Image, ImageDraw, ImageFont
+        from PIL import Image, ImageDraw
         cell_size = 100
         cell_border = 2
         interior_size = cell_size - 2 * cell_border
-        letters = self.letter_grid(assignment)
+        letters = self.letter_map(assignment)
 
         # Create a blank canvas
         img = Image.new(
@@ -63,9 +200,15 @@ class CrosswordCreator():
              self.crossword.height * cell_size),
             "black"
         )
-        font = ImageFont.truetype("assets/fonts/OpenSans-Regular.ttf", 80)
+        font = load_font(FONT_PATH, 80)
         draw = ImageDraw.Draw(img)
 
+        # Measure each distinct letter once, rather than once per cell
+        sizes = {
+            letter: draw.textbbox((0, 0), letter, font=font)[2:]
+            for letter in set(letters.values())
+        }
+
         for i in range(self.crossword.height):
             for j in range(self.crossword.width):
 
@@ -77,12 +220,13 @@ class CrosswordCreator():
                 ]
                 if self.crossword.structure[i][j]:
                     draw.rectangle(rect, fill="white")
-                    if letters[i][j]:
-                        _, _, w, h = draw.textbbox((0, 0), letters[i][j], font=font)
+                    letter = letters.get((i, j))
+                    if letter:
+                        w, h = sizes[letter]
                         draw.text(
                             (rect[0][0] + ((interior_size - w) / 2),
                              rect[0][1] + ((interior_size - h) / 2) - 10),
-                            letters[i][j], fill="black", font=font
+                            letter, fill="black", font=font
                         )
 
         img.save(filename)
@@ -101,10 +245,11 @@ class CrosswordCreator():
         (Remove any values that are inconsistent with a variable's unary
          constraints; in this case, the length of the word.)
         """
-        for node in copy.deepcopy(self.domains): # Loop over crossword nodes
-            for word in copy.deepcopy(self.domains[node]): # Loop over all words in each node's domain
-                if len(word) != node.length:
-                    self.domains[node].remove(word) # Remove words not equal to length of node
+        # Keep only words equal to the length of each node, in a single pass
+        self.domains = {
+            node: {word for word in words if len(word) == node.length}
+            for node, words in self.domains.items()
+        }
 
     def revise(self, x, y):
         """
@@ -114,21 +259,38 @@ class CrosswordCreator():
         Return True if a revision was made to the of `x`; return
         False if no revision was made
         """
-        if self.crossword.overlaps[x,y] == None: 
-            raise AssertionError # If no overlap, raise Error
-        
+        if self.crossword.overlaps[x,y] is None:
+            return False # If no overlap, there is no constraint to revise against
+
         i,j = self.crossword.overlaps[x,y] # return the co-ordinates of overlap
-        revised = False
-        for word_x in copy.deepcopy(self.domains[x]): # Loop over words in x's domain
-            arcConsistent = False
-            for word_y in copy.deepcopy(self.domains[y]): # Loop over words in y's domain
-                if word_x[i] == word_y[j]: 
-                    arcConsistent = True
-            if not arcConsistent:
-                self.domains[x].remove(word_x) # If not arc consistent, remove word from x domain
-                revised = True # Confirm x domain was updated
-            
-        return revised
+        letters = {word_y[j] for word_y in self.domains[y] if j < len(word_y)} # Letters y's domain can place at the overlap
+        unsupported = [
+            word_x for word_x in self.domains[x]
+            if i >= len(word_x) or word_x[i] not in letters
+        ]
+        if not unsupported:
+            return False # No revision was made
+
+        self.domains[x].difference_update(unsupported) # Remove words from x domain
+        return True # Confirm x domain was updated
+
+    def remove_bits(self, var, bits):
+        """
+        Remove the words in `bits` from the domain of `var`, recording them
+        in the current trail frame so that `restore` can undo the removal.
+        """
+        self.domain_bits[var] &= ~bits
+        self.domains[var].difference_update(self.from_bits(bits, var.length))
+        if self.trail:
+            self.trail[-1].append((var, bits))
+
+    def restore(self, frame):
+        """
+        Undo every removal recorded in trail `frame`.
+        """
+        for var, bits in frame:
+            self.domain_bits[var] |= bits
+            self.domains[var].update(self.from_bits(bits, var.length))
 
     def ac3(self, arcs=None):
         """
@@ -140,27 +302,64 @@ class CrosswordCreator():
         return False if one or more domains end up empty.
         """
 
-        """start with an initial queue of all of the arcs in the problem."""
-        if arcs is None:
-            queue = [] # Initialise empty queue
-            for node in copy.deepcopy(self.domains): # Loop over nodes
-                neighbors = self.crossword.neighbors(node) # Get neighbors for node
-                for neighbor in neighbors:
-                    queue.append((node,neighbor)) # Add arc to queue for each node
-        # Otherwise, begin with queue of only the arcs in the list arcs (where each arc is a tuple (x, y) of a variable x and a different variable y).
-        else:
-            queue = [(i,j) for (i,j) in arcs]
-        
-        while len(queue) != 0:
-            (i,j) = queue.pop(0) # Remove the first tuple from the queue, & assign to (i,j)
-            if self.revise(i,j): # If i wasn't consistent with j
-                if len(self.domains[i]) == 0: # If domain is empty, return False - No more solutions possible to trial
-                    return False
-                for k in self.crossword.neighbors(i): 
-                    if k != j:
-                        queue.append((k,i)) # Enqueue k,i arc
-        
-        return True # Once queue empty, arc-consistency should have been enforced.
+        if arcs is None: # Begin with all of the arcs in the problem
+            arcs = [(x,y) for x in self.domains for y in self._neighbors[x]]
+
+        if not self.sync_bits():
+            # Some domain holds words the bitmasks cannot represent, so revise
+            # arc by arc on the word sets themselves
+            queue = deque(arcs)
+            pending = set(queue) # Arcs currently waiting in the queue
+            while queue:
+                (x,y) = queue.popleft()
+                pending.discard((x,y))
+                if self.revise(x,y): # If x wasn't consistent with y
+                    if len(self.domains[x]) == 0: # If domain is empty, return False - No more solutions possible to trial
+                        return False
+                    for k in self._neighbors[x]:
+                        if k != y and (k,x) not in pending: # Skip arcs already waiting to be revised
+                            queue.append((k,x)) # Enqueue k,x arc
+                            pending.add((k,x))
+            return True
+
+        return self.propagate(arcs)
+
+    def propagate(self, arcs):
+        """
+        Make each variable arc consistent, as `ac3` does, starting from `arcs`
+        and working on the bitmask domains, which must already be in step
+        with `self.domains`. Return False if a domain ends up empty.
+        """
+        # Each round revises a batch of arcs (i,j), grouped by source variable i
+        incoming = defaultdict(list)
+        for (i,j) in arcs:
+            if self.crossword.overlaps[i,j] is not None:
+                incoming[i].append(j)
+
+        while incoming:
+            # Revise each source against all of its targets before touching
+            # its domain, so it is updated with a single removal
+            changed = []
+            for i, targets in incoming.items():
+                bits_i = self.domain_bits[i]
+                revised_bits = bits_i
+                for j in targets:
+                    revised_bits = revise_bits(
+                        revised_bits, self.domain_bits[j], self.column_pairs[i,j]
+                    )
+                if revised_bits != bits_i: # If i wasn't consistent with its targets
+                    self.remove_bits(i, bits_i & ~revised_bits)
+                    if not revised_bits: # If domain is empty, return False - No more solutions possible to trial
+                        return False
+                    changed.append(i)
+
+            # Every arc pointing into a changed variable is revised next round
+            incoming = defaultdict(list)
+            for j in changed:
+                for i in self._neighbors[j]:
+                    incoming[i].append(j)
+
+        return True # Once no arcs remain, arc-consistency should have been enforced.
 
     def assignment_complete(self, assignment):
         """
@@ -168,11 +367,11 @@ class CrosswordCreator():
         crossword variable); return False otherwise.
         """
     
-        for var in copy.deepcopy(assignment):
+        for var in assignment:
             if not assignment[var]: # If no value assigned, return False
                 return False
 
-        for variable in copy.deepcopy(self.crossword.variables):
+        for variable in self.crossword.variables:
             if variable not in assignment: # If any variable not in 'assignment'
                 return False
 
@@ -183,17 +382,16 @@ class CrosswordCreator():
         Return True if `assignment` is consistent (i.e., words fit in crossword
         puzzle without conflicting characters); return False otherwise.
         """
-        for var in copy.deepcopy(assignment):
-            var_word = assignment[var]
+        # All vars must be distinct - can only be one instance of each word
+        if len(set(assignment.values())) != len(assignment):
+            return False
 
-            # All vars must be distinct
-            if list(assignment.values()).count(var_word) > 1: # Can only be one isntance of each word
-                return False
+        for var, var_word in assignment.items():
             # All vars are correct length
             if len(var_word) != var.length:
                 return False
             # No conflicts between neighbors
-            neighbors = self.crossword.neighbors(var)
+            neighbors = self._neighbors[var]
             for neighbor in neighbors:
                 if neighbor in assignment: # Confirm that neighbor is in assignment
                     neighbor_word = assignment[neighbor]
@@ -209,22 +407,44 @@ class CrosswordCreator():
         The first value in the list, for example, should be the one
         that rules out the fewest values among the neighbors of `var`.
         """
-        neighbors = self.crossword.neighbors(var) # Get var's neighbors
+        use_bits = self.sync_bits() # Domains may have been changed directly since the masks were built
+        return self._rank_values(var, assignment, use_bits)
+
+    def _rank_values(self, var, assignment, use_bits):
+        """
+        Return the values in the domain of `var` in the order described by
+        `order_domain_values`. If `use_bits`, count neighbor words from the
+        bitmask domains, which must be in step with `self.domains`;
+        otherwise count them from the word sets.
+        """
+        neighbors = self._neighbors[var] # Get var's neighbors
         unassigned = [neighbor for neighbor in neighbors if neighbor not in assignment] # check for unnassigned variables in var's neighbors
-        rankings = dict() # Initialise a dictionary to count how many potential neighbor words are ruled out when selecting each word in var's domain.
+        rankings = {var_word: 0 for var_word in self.domains[var]} # Count how many potential neighbor words are ruled out when selecting each word in var's domain.
 
         for neighbor in unassigned: # Loop over unasssigned neighbors
             i,j = self.crossword.overlaps[var, neighbor] # Get index of overlapping indices
-            for var_word in copy.deepcopy(self.domains[var]):
-                n = 0 # Initialise count of eliminated choices
-                for neighbor_word in copy.deepcopy(self.domains[neighbor]): # Loop over words in neighbors' domain
-                    if var_word[i] != neighbor_word[j]:
-                        n += 1 # Increase count by one, as arc inconsistency
-                rankings[var_word] = rankings.get(var_word, 0) + n # Add count to 'rankings' dictionary
-        
-        # Having iterated over all neighbors, re-order dictionary in ascending order of n
-        ordered_variabes = [item[0] for item in sorted(rankings.items(), key=lambda item: item[1])]
-        return ordered_variabes
+            # Number of words in neighbor's domain, in total and with each
+            # letter at j, counted from the same source so the two agree
+            if use_bits:
+                bits_neighbor = self.domain_bits[neighbor]
+                size = bin(bits_neighbor).count("1")
+                frequency = {
+                    letter: bin(bits_neighbor & mask).count("1")
+                    for letter, mask in self.support[neighbor.length][j].items()
+                }
+            else:
+                size = len(self.domains[neighbor])
+                frequency = Counter(
+                    neighbor_word[j] for neighbor_word in self.domains[neighbor]
+                    if j < len(neighbor_word)
+                )
+            for var_word in rankings:
+                matching = frequency.get(var_word[i], 0) if i < len(var_word) else 0
+                rankings[var_word] += size - matching # Neighbor words without a matching letter are eliminated
+
+        # Having iterated over all neighbors, order words in ascending order of eliminated choices,
+        # breaking ties alphabetically so the order does not depend on the hash seed
+        return sorted(rankings, key=lambda var_word: (rankings[var_word], var_word))
 
     def select_unassigned_variable(self, assignment):
         """
@@ -234,35 +454,10 @@ class CrosswordCreator():
         degree. If there is a tie, any of the tied variables are acceptable
         return values.
         """
-        unassigned = [node for node in copy.deepcopy(self.crossword.variables) if node not in assignment]
-        # Count number of strings in node's domain
-        domainCounts = dict()
-        for node in unassigned:
-            domainCounts[node] = len(self.domains[node]) # Add to dict the length of domain for each variable
-        domainCounts = dict(item for item in sorted(domainCounts.items(), key=lambda item: item[1])) # Order dictionary by count of remaining values in domain
-        # Pick lowest. If TIE, choose variable w most neighbors.
-        minDomains = dict()
-        minCount = min(domainCounts.values()) # Get minimum count value
-        domainCounts_copy = copy.deepcopy(domainCounts) # Create copy of dict
-        for key, value in  domainCounts_copy.items():
-            if value == minCount:
-                minDomains[key] = value # Add all keys with smallest length domains
-
-        if len(minDomains) == 1:
-            minNode = list(minDomains.keys())[0]
-            return minNode # Return unnassigned variable
-        else: # Order next by their no. neighbors
-            neighborCount = dict() # Initialise dict for neighbor count
-            for key, value in minDomains.items():
-                count = len(self.crossword.neighbors(key))
-                neighborCount[key] = count # Add key, count pair to dict
-
-            minNeighborCount = min(neighborCount.values()) # Get min no. neighbors
-            minNeighbors = dict() # Initialise dictionary for storing the neighbor counts
-            for var, neighbors in neighborCount.items():
-                if neighbors == minNeighborCount: # All var's w min no. neighbors added to new dict
-                    return var
-                
+        unassigned = [node for node in self._ordered_variables if node not in assignment]
+        # Fewest remaining values first, then most neighbors, then the first in grid order
+        return min(unassigned, key=lambda node: (len(self.domains[node]), -self._degree[node]))
+
     def backtrack(self, assignment):
         """
         Using Backtracking Search, take as input a partial assignment for the
@@ -272,22 +467,43 @@ class CrosswordCreator():
 
         If no assignment is possible, return None.
         """
+        use_bits = self.sync_bits() # Bring the bitmasks in step with `self.domains` once, before searching
+        return self._search(assignment, use_bits)
+
+    def _search(self, assignment, use_bits):
+        """
+        Recursive step of `backtrack`.
+        If `use_bits`, each choice is followed by arc consistency on the
+        bitmask domains, which are kept in step with `self.domains`.
+        Otherwise some domain holds words the masks cannot represent, so
+        choices are checked with `consistent` alone, on the word sets.
+        """
         # Check if assignment complete
         checkCompletion = self.assignment_complete(assignment)
         if checkCompletion:
             return assignment # return complete assignment
         else:
             var = self.select_unassigned_variable(assignment) # select unassigned var
-            for word in copy.deepcopy(self.domains[var]): # loop through domain value
-                test_assignment = copy.deepcopy(assignment)
-                test_assignment[var] = word # trial adding each value to the assignment
-                checkConsistency = self.consistent(test_assignment) # check if assignment nodes are consistent w new value
+            for word in self._rank_values(var, assignment, use_bits): # loop through domain values, least constraining first
+                assignment[var] = word # trial adding each value to the assignment
+                checkConsistency = self.consistent(assignment) # check if assignment nodes are consistent w new value
                 if checkConsistency: # If consistent...
-                    assignment[var] = word # update actual 'assignment'
-                    result = self.backtrack(assignment) # recursion - call backtrack on new 'assignment'!
+                    if use_bits:
+                        self.trail.append([]) # Open a frame to log every word pruned for this choice
+                        # Narrow var's domain to the chosen word, then infer what this rules out for its neighbors
+                        self.remove_bits(var, self.domain_bits[var] & ~(1 << self.word_id[word]))
+                        arcs = [(neighbor, var) for neighbor in self._neighbors[var] if neighbor not in assignment]
+                        inferred = self.propagate(arcs)
+                    else:
+                        inferred = True # Nothing pruned, so the recursion relies on `consistent`
+                    result = self._search(assignment, use_bits) if inferred else None # recursion - call _search on new 'assignment'!
+                    if use_bits:
+                        frame = self.trail.pop()
+                        if not result:
+                            self.restore(frame) # Put back every word pruned for this choice
                     if result: # If result returns array, must be complete
                         return result
-                    del assignment[var] # If completion impossible, backtrack to try new value in domain
+                del assignment[var] # If inconsistent or completion impossible, backtrack to try new value in domain
 
         # If not possible to complete w current assignment of values, return None & backtrack
         return None